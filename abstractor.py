@@ -3,18 +3,25 @@
 This class contains the bot's handling of discord events.
 """
 
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 # import cloudscraper
 import config
 import discord
+from discord import app_commands
 import logging
 import messages
 import parser
 import re
+import time
 import traceback
+from typing import Optional
 
 # Import the logger from another file
 logger = logging.getLogger('discord')
 logger2 = logging.getLogger('servers')
+logger3 = logging.getLogger('summaries')
 
 # The regular expressions to identify AO3 and FFN links.
 # Note there may be an extra character at the beginning, due to checking
@@ -26,10 +33,194 @@ FFN_MATCH = re.compile(
 SB_MATCH = re.compile(
     "(^|[^!])https?:\\/\\/forums.spacebattles.com\\/threads\\/[-\\.\\w\\d]+\\/")
 
+# The most links answered per message
+MAX_LINKS = 3
+
+# Threads that run parser functions; upstream.py sizes its pool to match
+PARSER_EXECUTOR = ThreadPoolExecutor(max_workers=config.FETCH_WORKERS)
+
+
+def find_links(content):
+    """Find the fanfiction links in a message.
+
+    content should be the lowercased message text.
+    Returns a list of (site, link, key) tuples, where link is the cleaned up
+    link to fetch and key identifies the fic, so a fic linked twice or with
+    and without a collection is only answered once.
+    """
+    links = []
+    seen = set()
+    num_processed = 0
+
+    # check for AO3 links
+    for link in AO3_MATCH.finditer(content):
+        if num_processed >= MAX_LINKS:
+            break
+        num_processed += 1
+        # clean up link
+        link = link.group(0).replace("http://", "https://")\
+            .replace("www.", "")
+        # regex match may include an extra character at the start
+        if not link.startswith("https://"):
+            link = link[1:]
+        # Strip "collection from URL before checking for duplicate links.
+        base_link = parser.strip_collection(link)
+        # do not link a fic more than once per message
+        if base_link in seen:
+            continue
+        seen.add(base_link)
+        links.append(("AO3", link, base_link))
+
+    # Check for FFN links
+    for link in FFN_MATCH.finditer(content):
+        if num_processed >= MAX_LINKS:
+            break
+        num_processed += 1
+        # Standardize link format
+        link = link.group(0).replace(
+            "http://", "https://").replace("m.", "www.")
+        link = link.replace(
+            "https://fanfiction.net", "https://www.fanfiction.net")
+        if not link.startswith("https://"):
+            link = link[1:]
+        if link.endswith("__cf_"):
+            link = link[:-6]
+        # If a fic is linked multiple times, only send one message
+        if link in seen:
+            continue
+        seen.add(link)
+        links.append(("FFN", link, link))
+
+    # spacebattles!
+    # this is currently disabled: see the break 3 lines down from here
+    for link in SB_MATCH.finditer(content):
+        break
+        if num_processed >= MAX_LINKS:
+            break
+        num_processed += 1
+        # clean up link
+        link = link.group(0).replace("http://", "https://")
+        # regex match may include an extra character at the start
+        if not link.startswith("https://"):
+            link = link[1:]
+        # do not link a fic more than once per message
+        if link in seen:
+            continue
+        seen.add(link)
+        links.append(("SpaceBattles", link, link))
+
+    return links
+
+
+class AnsweredLinks:
+    """Remember which links were answered for recent messages.
+
+    At most config.EDIT_HISTORY_SIZE messages are kept, each for
+    config.EDIT_HISTORY_TTL seconds after the bot first saw it.
+    """
+
+    def __init__(self):
+        self.messages = OrderedDict()
+
+    def expire(self):
+        cutoff = time.monotonic() - config.EDIT_HISTORY_TTL
+        while self.messages:
+            seen_at, _ = next(iter(self.messages.values()))
+            if seen_at >= cutoff and \
+                    len(self.messages) <= config.EDIT_HISTORY_SIZE:
+                break
+            self.messages.popitem(last=False)
+
+    def add(self, message_id, keys):
+        """Record that the links with these keys were answered."""
+        if message_id in self.messages:
+            self.messages[message_id][1].update(keys)
+        else:
+            self.messages[message_id] = (time.monotonic(), keys)
+        self.expire()
+
+    def get(self, message_id):
+        """Returns the keys answered for a message, or None if unknown."""
+        self.expire()
+        entry = self.messages.get(message_id)
+        return entry[1] if entry else None
+
+
+async def run_parser(func, *args):
+    """Run a parser function on a worker thread and return its result.
+
+    Fetches block for as long as the site takes, including retries and
+    hedged requests, so they must not run on the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(PARSER_EXECUTOR, func, *args)
+
+
+def scans_messages(guild_id):
+    """Returns True if messages in the guild should be checked for links."""
+    return config.scan_messages and guild_id not in config.servers_no_scanning
+
+
+@app_commands.command(
+    name="abstract", description="Post information about a fanfiction link.")
+@app_commands.describe(
+    link="A link to an AO3 or FFN work, or an AO3 series",
+    work="The number of a work in the AO3 series to post instead")
+async def abstract(interaction: discord.Interaction, link: str,
+                   work: Optional[app_commands.Range[int, 1]] = None):
+    """Post the summary for one link, replying once it is ready."""
+    # acknowledge now, since fetching can take longer than discord waits
+    await interaction.response.defer(thinking=True)
+    client = interaction.client
+    links = find_links(link.lower())
+    if not links:
+        await interaction.followup.send(messages.NO_LINK)
+        return
+    site, link, key = links[0]
+
+    if work is not None:
+        if "/series/" not in link:
+            await interaction.followup.send(messages.NOT_SERIES)
+            return
+        try:
+            work_link = await run_parser(
+                parser.identify_work_in_ao3_series, link, work)
+        except Exception:
+            logger.exception(
+                "Failed to find work in series",
+                extra={"link": key, "guild": interaction.guild_id})
+            work_link = None
+        if not work_link:
+            await interaction.followup.send(
+                messages.NO_WORK.format(work, link))
+            return
+        link = key = "https://archiveofourown.org" + work_link
+
+    output = await client.fetch_summary(
+        site, link, key, interaction.guild_id)
+    if not output:
+        output = messages.NO_SUMMARY.format(link)
+    await interaction.followup.send(output)
+
 
 class Abstractor(discord.Client):
     """The discord bot client itself."""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.answered = AnsweredLinks()
+        self.tree = app_commands.CommandTree(self)
+        self.tree.add_command(abstract)
+
+    async def setup_hook(self):
+        """Register the slash commands with discord if config.py asks to.
+
+        Syncing is rate limited and only needed when the commands change,
+        so it is not done on every start.
+        """
+        if config.sync_commands:
+            await self.tree.sync()
+
     async def on_ready(self):
         """When starting bot, print the servers it is part of."""
         s = "Logged on!\nMember of:\n"
@@ -70,130 +261,13 @@ class Abstractor(discord.Client):
                 output = messages.introduction(message.guild.id)
                 await message.channel.send(output)
 
-        # check for AO3 links
-        ao3_links = AO3_MATCH.finditer(content)
-        links_processed = set()
-        max_links = 3
-        num_processed = 0
-        for link in ao3_links:
-            if num_processed >= max_links:
-                break
-            else:
-                num_processed += 1
-            # clean up link
-            link = link.group(0).replace("http://", "https://")\
-                .replace("www.", "")
-            # regex match may include an extra character at the start
-            if not link.startswith("https://"):
-                link = link[1:]
-            # Strip "collection from URL before checking for duplicate links.
-            base_link = link
-            if "/collections/" in base_link:
-                base_link = link.split("/")
-                base_link.pop(3)
-                base_link.pop(3)
-                base_link = "/".join(base_link)
-            # do not link a fic more than once per message
-            if base_link in links_processed:
-                continue
-            links_processed.add(base_link)
-            add_blank_line = num_processed > 1
-
-            # Attempt to get summary of AO3 work or series
-            output = ""
-            async with message.channel.typing():
-                try:
-                    if "/works/" in link:
-                        output = parser.generate_ao3_work_summary(link)
-                    elif "/series/" in link:
-                        output = parser.generate_ao3_series_summary(link)
-                    elif "/chapters/" in link:
-                        output = parser.generate_ao3_work_summary(link)
-                # if the process fails for an unhandled reason, print error
-                except Exception:
-                    logger.exception("Failed to get AO3 summary for {}".format(base_link))
-            if len(output) > 0:
-                if num_processed > 1:
-                    output = "** **\n" + output
-                await message.channel.send(output)
-
-
-        # Check for FFN links
-        ffn_links = FFN_MATCH.finditer(content)
-        for link in ffn_links:
-            if num_processed >= max_links:
-                break
-            else:
-                num_processed += 1
-            # Standardize link format
-            if "m.fanfiction.net" in link.group(0):
-                mobile = True
-            else:
-                mobile = False
-            if link.group(0).endswith("__cf_"):
-                mobile = True
-            link = link.group(0).replace(
-                "http://", "https://").replace("m.", "www.")
-            link = link.replace(
-                "https://fanfiction.net", "https://www.fanfiction.net")
-            if not link.startswith("https://"):
-                link = link[1:]
-            if link.endswith("__cf_"):
-                link = link[:-6]
-            # If a fic is linked multiple times, only send one message
-            if link in links_processed:
-                continue
-            links_processed.add(link)
-
-            # Generate the summary and send it
-            output = ""
-            async with message.channel.typing():
-                try:
-                    output = parser.generate_ffn_work_summary(link)
-                # We can't resolve cloudflare errors
-                # but if the link was a mobile link, send the normal one
-                # should no longer happen with ficlab API
-                # except cloudscraper.exceptions.CloudflareException:
-                #     if mobile:
-                #         output = link
-                except Exception:
-                    logger.exception("Failed to get FFN summary")
-            if len(output) > 0:
-                if num_processed > 1:
-                    output = "** **\n" + output
-                await message.channel.send(output)
-
-
-        # spacebattles!
-        # this is currently disabled: see the break 3 lines down from here
-        sb_links = SB_MATCH.finditer(content)
-        for link in sb_links:
-            break
-            if num_processed >= max_links:
-                break
-            else:
-                num_processed += 1
-            # clean up link
-            link = link.group(0).replace("http://", "https://")
-            # regex match may include an extra character at the start
-            if not link.startswith("https://"):
-                link = link[1:]
-            # do not link a fic more than once per message
-            if link in links_processed:
-                continue
-            links_processed.add(link)
-
-            # Attempt to get summary of SB work
-            output = ""
-            async with message.channel.typing():
-                try:
-                    output = parser.generate_sb_summary(link)
-                # if the process fails for an unhandled reason, print error
-                except Exception:
-                    logger.exception("Failed to get SpaceBattles summary")
-            if len(output) > 0:
-                await message.channel.send(output)
-
+        if scans_messages(message.guild.id):
+            links = find_links(content)
+            # record links before fetching, so an edit made while they are
+            # being fetched does not post them again
+            self.answered.add(message.id, set(key for _, _, key in links))
+            await self.post_summaries(
+                message.channel, message.guild.id, links)
 
         # if a bot message is replied to with "delete", delete the message
         if message.guild.id not in config.servers_no_deletion:
@@ -203,6 +277,76 @@ class Abstractor(discord.Client):
                         await message.reference.resolved.delete()
 
 
+    async def on_message_edit(self, before, after):
+        """Answer links that were added to a message by editing it.
+
+        Only links in the new content that were neither in the old content
+        nor already answered for the message are fetched, so edits that do
+        not add links make no requests at all.
+        discord.py only reports edits to messages it still has cached.
+        """
+        if after.author == self.user:
+            return
+        if after.author.bot and not after.author.id in config.bots_allow:
+            return
+        if before.content == after.content:
+            return
+        if not scans_messages(after.guild.id):
+            return
+        answered = self.answered.get(after.id)
+        # too old to remember what was answered, so leave it alone
+        if answered is None:
+            return
+
+        old_links = find_links(before.content.lower())
+        old_keys = set(key for _, _, key in old_links)
+        links = [link for link in find_links(after.content.lower())
+                 if link[2] not in old_keys and link[2] not in answered]
+        if not links:
+            return
+        self.answered.add(after.id, set(key for _, _, key in links))
+        await self.post_summaries(after.channel, after.guild.id, links)
+
+    async def fetch_summary(self, site, link, key, guild_id):
+        """Returns the summary for a link from find_links, or a blank string."""
+        start = time.perf_counter()
+        output = ""
+        if site == "AO3":
+            if "/series/" in link:
+                generate = parser.generate_ao3_series_summary
+            else:
+                generate = parser.generate_ao3_work_summary
+        elif site == "FFN":
+            generate = parser.generate_ffn_work_summary
+        elif site == "SpaceBattles":
+            generate = parser.generate_sb_summary
+        try:
+            output = await run_parser(generate, link)
+        # if the process fails for an unhandled reason, print error
+        except Exception:
+            logger.exception(
+                "Failed to get {} summary".format(site), extra={
+                    "link": key, "guild": guild_id, "timings": {
+                        "fetch": time.perf_counter() - start}})
+        return output or ""
+
+    async def post_summaries(self, channel, guild_id, links):
+        """Fetch and send the summary for each link from find_links."""
+        for i, (site, link, key) in enumerate(links):
+            start = time.perf_counter()
+            async with channel.typing():
+                output = await self.fetch_summary(
+                    site, link, key, guild_id)
+            fetched = time.perf_counter()
+            if output:
+                if i > 0 and site != "SpaceBattles":
+                    output = "** **\n" + output
+                await channel.send(output)
+                logger3.info("Posted %s summary", site, extra={
+                    "link": key, "guild": guild_id, "timings": {
+                        "fetch": fetched - start,
+                        "send": time.perf_counter() - fetched}})
+
     async def on_reaction_add(self, reaction, user):
         """If react is added to bot's series message, send work information.
 
@@ -222,14 +366,18 @@ class Abstractor(discord.Client):
         # regex match may include an extra character at the start
         if not series.startswith("https://"):
             series = series[1:]
-        link = "https://archiveofourown.org"\
-            + parser.identify_work_in_ao3_series(series, fic)
-        if link:
-            output = ""
+        guild_id = reaction.message.guild.id
+        try:
+            work = await run_parser(
+                parser.identify_work_in_ao3_series, series, fic)
+        except Exception:
+            logger.exception(
+                "Failed to find work in series",
+                extra={"link": series, "guild": guild_id})
+            return
+        if work:
+            link = "https://archiveofourown.org" + work
             async with reaction.message.channel.typing():
-                try:
-                    output = parser.generate_ao3_work_summary(link)
-                except Exception:
-                    logger.exception("Failed to generate summary for work in series")
+                output = await self.fetch_summary("AO3", link, link, guild_id)
             if len(output) > 0:
                 await reaction.message.channel.send(output)
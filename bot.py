@@ -2,7 +2,8 @@
 
 """This is a duplicate of the Fanfic Rec Bot, but it works better.
 
-Required files are: bot.py, config.py, abstractor.py, messages.py, parser.py
+Required files are: bot.py, config.py, abstractor.py, messages.py, parser.py,
+    upstream.py, logs.py
 To run the bot, execute bot.py and leave it running.
 
 config.py must contain the bot token as a variable, token.
@@ -11,6 +12,11 @@ To disable deleting bot messages by replying with "delete",
     put the server ID in config.py in servers_no_deletion.
 To disable getting info about fics by replying to series messages,
     put the server ID in config.py in servers_no_reacts.
+To only answer /abstract and not check messages for links,
+    put the server ID in config.py in servers_no_scanning,
+    or set scan_messages to False to disable it everywhere.
+To register /abstract with discord, set sync_commands in config.py to True
+    for one start.
 These must be blank lists or sets, otherwise.
 
 quihi
@@ -20,30 +26,22 @@ import abstractor
 import config
 import discord
 import logging
+import logs
 import sys
 
 
 def main():
     """Run the discord bot."""
     # set up logging
-    logger = logging.getLogger('discord')
-    logger.setLevel(logging.WARNING)
-    handler = logging.FileHandler(
-        filename='discord.log', encoding='utf-8', mode='a')
-    handler.setFormatter(logging.Formatter(
-        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    logger.addHandler(handler)
-
-    logger = logging.getLogger('servers')
-    logger.setLevel(logging.INFO)
-    handler = logging.FileHandler(
-        filename='servers.log', encoding='utf-8', mode='a')
-    handler.setFormatter(logging.Formatter(
-        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    logger.addHandler(handler)
+    listeners = [
+        logs.setup('discord', 'discord.log', logging.WARNING),
+        logs.setup('servers', 'servers.log', logging.INFO),
+        logs.setup('summaries', 'summaries.log', logging.INFO),
+    ]
 
     # create discord client
-    intents = discord.Intents(messages=True, reactions=True, guilds=True)
+    intents = discord.Intents(messages=True, reactions=True, guilds=True,
+                              message_content=config.scan_messages)
     activity = discord.Activity(
         name='@me help',
         type=discord.ActivityType.playing)
@@ -56,7 +54,12 @@ def main():
     # run the bot
     print(sys.version)
     print("Completed setup!")
-    client.run(config.token)
+    try:
+        # log_handler=None keeps discord.py from adding its own log handler
+        client.run(config.token, log_handler=None)
+    finally:
+        for listener in listeners:
+            listener.stop()
 
 
 if __name__ == '__main__':
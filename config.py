@@ -19,6 +19,69 @@ servers_no_deletion = set([123456789012345678, 234567890123456789])
 # Server IDs where reacting to a series message to get fic info is disabled
 servers_no_reacts = set([123456789012345678, 234567890123456789])
 
+# Check every message for links.  If False, the bot only answers /abstract
+# and does not need the message content intent.
+scan_messages = True
+
+# Register /abstract with discord when the bot starts.  Set this to True
+# for one start after adding the bot or updating it, then back to False,
+# since registering is rate limited.
+sync_commands = False
+
+# Server IDs where messages are not checked for links, only /abstract is used
+servers_no_scanning = set([123456789012345678, 234567890123456789])
+
 # User IDs of bots whose content should be checked for links
 bots_allow = set([123456789012345678])
 
+
+# Seconds to wait for each site before giving up: (connect, read).
+# Read timeouts are not retried, so a page never waits much longer than this.
+UPSTREAM_TIMEOUTS = {
+    "archiveofourown.org": (5, 20),
+    "fichub.net": (5, 30),
+}
+DEFAULT_TIMEOUT = (5, 20)
+
+# Number of lookups that can fetch from the sites at the same time
+FETCH_WORKERS = 8
+
+# Stop contacting a site after this many lookups in a row fail (a lookup
+# only counts as failed once its retries are used up),
+# then try it again after this many seconds
+BREAKER_FAILURES = 5
+BREAKER_RECOVERY = 60
+
+# Retry failed requests this many times, waiting a random time up to
+# base * 2^attempt seconds (capped at the maximum) between attempts
+RETRY_ATTEMPTS = 2
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 4
+
+# Send a second copy of a request that is slower than this percentile of
+# recent requests to the same site; set to None to disable
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+
+# Each request to a site earns this many retries or hedges, up to the maximum,
+# so retries cannot pile onto a site that is down
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10
+
+# Number of summaries remembered to post while a site is not responding
+STALE_CACHE_SIZE = 1000
+
+# Number of recent messages, and for how many seconds, to remember which
+# links were answered, so editing a message only answers newly added links
+EDIT_HISTORY_SIZE = 5000
+EDIT_HISTORY_TTL = 3600
+
+# Log files are rotated at this many bytes, keeping this many old files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+# The same error is only logged once in this many seconds
+LOG_DEDUP_WINDOW = 60
+
+# Log records waiting to be written; any more are dropped
+LOG_QUEUE_SIZE = 10000
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3.8
+
+"""loadtest.py drives the bot with fake discord events and fake sites.
+
+No network access or bot token is needed.  A local HTTP server stands in for
+AO3 and fichub, serving recorded pages with injected latency and errors, and
+upstream.OVERRIDES points the parser at it.  Synthetic messages and reactions
+are passed to Abstractor.on_message and Abstractor.on_reaction_add at a fixed
+rate, and the script reports reply latency percentiles, throughput, event
+loop lag and memory use.  Links that never got a reply are reported
+separately, with how long the bot took to give up on them.
+
+Example:
+    python3 loadtest.py --rate 20 --duration 60 --latency 300 --error-rate 0.05
+
+By default the fake sites serve small built-in pages.  To serve recorded
+pages instead, save an AO3 work page, an AO3 series page and a fichub API
+response as work.html, series.html and fichub.json in a directory and pass
+it with --fixtures.  "{id}" in a recorded page is replaced by the requested
+work or series ID.
+"""
+
+import abstractor
+import argparse
+import asyncio
+import discord
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import messages
+import os
+import parser
+import random
+import resource
+import threading
+import time
+import upstream
+
+WORK_PAGE = """<html><body>
+<ul><li class="share"><a href="/works/{id}/share">Share</a></li></ul>
+<dl class="work meta group">
+<dt>Rating:</dt><dd class="rating tags"><ul><li><a>Teen And Up Audiences</a></li></ul></dd>
+<dt>Archive Warning:</dt><dd class="warning tags"><ul><li><a>No Archive Warnings Apply</a></li></ul></dd>
+<dt>Category:</dt><dd class="category tags"><ul><li><a>Gen</a></li></ul></dd>
+<dt>Fandom:</dt><dd class="fandom tags"><ul><li><a>Load Test Fandom</a></li></ul></dd>
+<dt>Relationship:</dt><dd class="relationship tags"><ul><li><a>Alice &amp; Bob</a></li></ul></dd>
+<dt>Characters:</dt><dd class="character tags"><ul><li><a>Alice</a></li><li><a>Bob</a></li><li><a>Carol</a></li></ul></dd>
+<dt>Additional Tags:</dt><dd class="freeform tags"><ul><li><a>Fluff</a></li><li><a>Found Family</a></li></ul></dd>
+<dt>Series:</dt><dd class="series"><span class="series"><span class="position">Part 1 of <a href="/series/{id}">the Load Test series</a></span></span></dd>
+<dt>Stats:</dt><dd class="stats"><dl class="stats">
+<dt>Published:</dt><dd class="published">2021-01-01</dd>
+<dt>Words:</dt><dd class="words">12,345</dd>
+<dt>Chapters:</dt><dd class="chapters">3/?</dd>
+<dt>Kudos:</dt><dd class="kudos">678</dd>
+</dl></dd>
+</dl>
+<div class="preface group">
+<h2 class="title heading">Load Test Work {id}</h2>
+<h3 class="byline heading"><a rel="author" href="/users/tester">tester</a></h3>
+<div class="summary module"><h3 class="heading">Summary:</h3>
+<blockquote class="userstuff"><p>A work served by the load test harness.</p></blockquote></div>
+</div>
+</body></html>
+"""
+
+SERIES_PAGE = """<html><body>
+<h2 class="heading">Load Test Series {id}</h2>
+<dl class="series meta group">
+<dt>Creator:</dt><dd><a rel="author" href="/users/tester">tester</a></dd>
+<dt>Series Begun:</dt><dd>2021-01-01</dd>
+<dt>Series Updated:</dt><dd>2021-06-01</dd>
+<dt>Description:</dt><dd><blockquote class="userstuff"><p>A series served by the load test harness.</p></blockquote></dd>
+<dt>Stats:</dt><dd><dl class="stats">
+<dt>Words:</dt><dd>50,000</dd>
+<dt>Works:</dt><dd>5</dd>
+<dt>Complete:</dt><dd>No</dd>
+</dl></dd>
+</dl>
+<ul class="series work index group">
+<li class="work blurb group work-1"><h4 class="heading"><a href="/works/1">First Work</a></h4></li>
+<li class="work blurb group work-2"><h4 class="heading"><a href="/works/2">Second Work</a></h4></li>
+<li class="work blurb group work-3"><h4 class="heading"><a href="/works/3">Third Work</a></h4></li>
+<li class="work blurb group work-4"><h4 class="heading"><a href="/works/4">Fourth Work</a></h4></li>
+<li class="work blurb group work-5"><h4 class="heading"><a href="/works/5">Fifth Work</a></h4></li>
+</ul>
+</body></html>
+"""
+
+FICHUB_RESPONSE = json.dumps({"meta": {
+    "title": "Load Test Story",
+    "author": "tester",
+    "description": "<p>A story served by the load test harness.</p>",
+    "status": "ongoing",
+    "chapters": 7,
+    "words": 23456,
+    "updated": "2021-06-01T12:00:00",
+    "extraMeta": "Rated: Fiction T - English - Adventure/Humor - Alice, Bob"
+                 " - Chapters: 7 - Words: 23,456 - Reviews: 12 - Favs: 34"
+                 " - Follows: 56",
+}})
+
+CHATTER = [
+    "has anyone read anything good lately?",
+    "I finally finished that long fic everyone was talking about",
+    "recs for found family please!",
+    "lol",
+    "the new chapter was so good, I can't stop thinking about it",
+]
+
+
+def load_fixtures(directory):
+    """Returns the pages to serve, using recordings from directory if any."""
+    fixtures = {"work": WORK_PAGE, "series": SERIES_PAGE,
+                "fichub": FICHUB_RESPONSE}
+    if directory:
+        for name, filename in (("work", "work.html"),
+                               ("series", "series.html"),
+                               ("fichub", "fichub.json")):
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    fixtures[name] = f.read()
+    return fixtures
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    """Serve AO3 and fichub pages with injected latency and errors."""
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(max(0, random.gauss(server.latency, server.jitter)))
+        with server.lock:
+            server.requests += 1
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self.send_error(503)
+            return
+
+        path = self.path.split("?")[0]
+        item_id = path.strip("/").split("/")[-1]
+        if path.startswith("/api/v0/epub"):
+            body = server.fixtures["fichub"]
+            content_type = "application/json"
+        elif path.startswith("/series/"):
+            body = server.fixtures["series"].replace("{id}", item_id)
+            content_type = "text/html"
+        elif path.startswith(("/works/", "/chapters/")):
+            body = server.fixtures["work"].replace("{id}", item_id)
+            content_type = "text/html"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_sites(fixtures, latency, jitter, error_rate):
+    """Start the stand-in server and point AO3 and fichub requests at it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSiteHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.errors = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    upstream.OVERRIDES["archiveofourown.org"] = base
+    upstream.OVERRIDES["fichub.net"] = base
+    return server
+
+
+class FakeUser:
+    """A discord user or bot that sends the synthetic messages."""
+
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.bot = bot
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeChannel:
+    """A channel that records how long the bot took to reply to one event.
+
+    expected is the number of summaries the event should produce.
+    """
+
+    def __init__(self, harness, guild, expected):
+        self.harness = harness
+        self.guild = guild
+        self.expected = expected
+        self.replies = 0
+        self.started = time.perf_counter()
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content):
+        await asyncio.sleep(self.harness.send_latency)
+        self.harness.latencies.append(time.perf_counter() - self.started)
+        self.replies += 1
+        if content.startswith(messages.STALE_NOTE):
+            self.harness.stale += 1
+        sent = FakeMessage(self.harness.next_id(), content,
+                           self.harness.client.user, self.guild, self)
+        if "archiveofourown.org/series/" in content.split("\n")[0]:
+            self.harness.series_messages.append(sent)
+        return sent
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, guild, channel):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.reference = None
+
+    async def delete(self):
+        pass
+
+
+class FakeReaction:
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+        self.count = 1
+
+
+class Harness:
+    """Generate events for the bot and collect measurements."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.client = abstractor.Abstractor(intents=discord.Intents.default())
+        self.guilds = [FakeGuild(900000000000000000 + i)
+                       for i in range(args.guilds)]
+        self.users = [FakeUser(800000000000000000 + i)
+                      for i in range(args.users)]
+        self.send_latency = args.send_latency / 1000
+        self._ids = itertools.count(700000000000000000)
+        self.series_messages = []
+        self.latencies = []
+        self.lags = []
+        self.messages = 0
+        self.reactions = 0
+        self.failures = 0
+        self.lookups = 0
+        self.unanswered = 0
+        self.stale = 0
+        self.give_ups = []
+
+    def next_id(self):
+        return next(self._ids)
+
+    def make_content(self):
+        """Returns the text of a synthetic message."""
+        rng = self.rng
+        if rng.random() >= self.args.link_ratio:
+            return rng.choice(CHATTER)
+        links = []
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            kind = rng.choice(("works", "works", "series", "chapters", "ffn"))
+            item_id = rng.randint(1, self.args.works)
+            if kind == "ffn":
+                links.append("https://www.fanfiction.net/s/{}/1/".format(
+                    item_id))
+            else:
+                links.append("https://archiveofourown.org/{}/{}".format(
+                    kind, item_id))
+        return "{} {}".format(rng.choice(CHATTER), " ".join(links))
+
+    def make_event(self):
+        """Returns a coroutine for the next on_message or on_reaction_add."""
+        rng = self.rng
+        guild = rng.choice(self.guilds)
+        if self.series_messages and rng.random() < self.args.react_ratio:
+            self.reactions += 1
+            series = rng.choice(self.series_messages)
+            channel = FakeChannel(self, guild, 1)
+            message = FakeMessage(series.id, series.content, series.author,
+                                  series.guild, channel)
+            emoji = rng.choice(list(parser.REACTS)[:5])
+            return channel, self.client.on_reaction_add(
+                FakeReaction(message, emoji), rng.choice(self.users))
+        self.messages += 1
+        content = self.make_content()
+        expected = 0
+        if abstractor.scans_messages(guild.id):
+            expected = len(abstractor.find_links(content.lower()))
+        channel = FakeChannel(self, guild, expected)
+        message = FakeMessage(self.next_id(), content,
+                              rng.choice(self.users), guild, channel)
+        return channel, self.client.on_message(message)
+
+    async def run_event(self, channel, event):
+        try:
+            await event
+        except Exception:
+            self.failures += 1
+        # lookups the bot gave up on send nothing, so count them here;
+        # otherwise more injected errors would make the latencies look better
+        self.lookups += channel.expected
+        missing = channel.expected - channel.replies
+        if missing > 0:
+            self.unanswered += missing
+            self.give_ups.append(time.perf_counter() - channel.started)
+
+    async def monitor_lag(self, interval=0.05):
+        """Measure how late the event loop wakes up from a sleep."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.lags.append(loop.time() - start - interval)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        monitor = asyncio.ensure_future(self.monitor_lag())
+        interval = 1 / self.args.rate
+        start = loop.time()
+        next_event = start
+        tasks = []
+        while loop.time() - start < self.args.duration:
+            tasks.append(asyncio.ensure_future(
+                self.run_event(*self.make_event())))
+            next_event += interval
+            await asyncio.sleep(max(0, next_event - loop.time()))
+        sending_done = loop.time()
+        await asyncio.gather(*tasks)
+        monitor.cancel()
+        return sending_done - start, loop.time() - start
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Returns the given percentiles of samples, plus the maximum."""
+    if not samples:
+        return [0.0] * (len(points) + 1)
+    samples = sorted(samples)
+    result = [samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+              for p in points]
+    return result + [samples[-1]]
+
+
+def current_rss():
+    """Returns the resident memory of this process in MiB."""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 2 ** 20
+
+
+def report(harness, server, sending, total, rss_start):
+    """Print the results of a run."""
+    args = harness.args
+    print("Sent {} messages and {} reactions in {:.1f}s (target {}/s)".format(
+        harness.messages, harness.reactions, sending, args.rate))
+    print("Finished after {:.1f}s; {} events raised exceptions".format(
+        total, harness.failures))
+    print("Replies: {} ({:.1f}/s)".format(
+        len(harness.latencies), len(harness.latencies) / total))
+    print("Reply latency ms   p50 {:.0f}  p90 {:.0f}  p99 {:.0f}  max {:.0f}"
+          .format(*(s * 1000 for s in percentiles(harness.latencies))))
+    print("Lookups: {} expected, {} unanswered ({:.1%}), {} stale replies"
+          .format(harness.lookups, harness.unanswered,
+                  harness.unanswered / max(1, harness.lookups),
+                  harness.stale))
+    print("Gave up after ms   p50 {:.0f}  p90 {:.0f}  p99 {:.0f}  max {:.0f}"
+          .format(*(s * 1000 for s in percentiles(harness.give_ups))))
+    print("Event loop lag ms  p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}"
+          .format(*(s * 1000 for s in percentiles(harness.lags))))
+    print("Fake site requests: {} ({} injected errors)".format(
+        server.requests, server.errors))
+    print("Memory MiB: start {:.1f}  end {:.1f}  peak {:.1f}".format(
+        rss_start, current_rss(),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    """Run a load test against the bot with fake discord and fake sites."""
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--rate", type=float, default=10,
+                            help="events per second")
+    arg_parser.add_argument("--duration", type=float, default=30,
+                            help="seconds to send events for")
+    arg_parser.add_argument("--link-ratio", type=float, default=0.3,
+                            help="fraction of messages containing links")
+    arg_parser.add_argument("--react-ratio", type=float, default=0.05,
+                            help="fraction of events that react to a series")
+    arg_parser.add_argument("--works", type=int, default=500,
+                            help="number of distinct work IDs to link")
+    arg_parser.add_argument("--guilds", type=int, default=20)
+    arg_parser.add_argument("--users", type=int, default=200)
+    arg_parser.add_argument("--latency", type=float, default=200,
+                            help="mean fake site latency in ms")
+    arg_parser.add_argument("--jitter", type=float, default=100,
+                            help="standard deviation of the latency in ms")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="fraction of fake site requests that fail")
+    arg_parser.add_argument("--send-latency", type=float, default=50,
+                            help="fake discord latency for sending, in ms")
+    arg_parser.add_argument("--fixtures",
+                            help="directory of recorded pages to serve")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    server = start_fake_sites(load_fixtures(args.fixtures),
+                              args.latency / 1000, args.jitter / 1000,
+                              args.error_rate)
+    rss_start = current_rss()
+
+    async def run():
+        harness = Harness(args)
+        sending, total = await harness.run()
+        return harness, sending, total
+
+    harness, sending, total = asyncio.run(run())
+    report(harness, server, sending, total, rss_start)
+
+
+if __name__ == '__main__':
+    main()
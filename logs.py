@@ -0,0 +1,196 @@
+"""logs.py writes the bot's logs from a background thread.
+
+Loggers set up here only put records on a queue, so logging an exception
+on the event loop does no file I/O.  A listener thread formats each record
+as one JSON object per line and writes it to a file that is rotated by size.
+Repeats of the same exception within config.LOG_DEDUP_WINDOW seconds are
+dropped, and a summary record says how many were dropped.
+Records that do not fit in the queue are also dropped and counted.
+
+Extra fields can be attached to a record with the extra argument, e.g.
+    logger.exception("Failed", extra={"link": link, "guild": guild_id,
+                                      "timings": {"fetch": 1.5}})
+"""
+
+from collections import OrderedDict
+import config
+from datetime import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# record attributes copied into the JSON output when present
+EXTRA_FIELDS = ("link", "guild", "timings", "suppressed", "dropped")
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record as a single line of JSON."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created)
+                .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DedupFilter(logging.Filter):
+    """Let an exception through at most once per window.
+
+    Exceptions are the same if they come from the same logger, have the same
+    type and were raised from the same line, whatever their message says,
+    since connection errors include the URL.  When a window ends, a summary
+    record says how many repeats were dropped.  At most max_keys exceptions
+    are tracked; the oldest window is ended early to make room.
+    """
+
+    def __init__(self, window, handler, max_keys=1000):
+        super().__init__()
+        self.window = window
+        self.handler = handler
+        self.max_keys = max_keys
+        # key -> [window start, repeats dropped, logger, level, message];
+        # windows start in insertion order, so expired ones are at the front
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        self.expire(record.created)
+        if not record.exc_info:
+            return True
+        key = self.key(record)
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is None:
+                self.seen[key] = [record.created, 0, record.name,
+                                  record.levelno, record.getMessage()]
+                return True
+            entry[1] += 1
+            first_repeat = entry[1] == 1
+        if first_repeat:
+            # make sure the summary is written even if nothing else is logged
+            timer = threading.Timer(
+                entry[0] + self.window - record.created, self.expire)
+            timer.daemon = True
+            timer.start()
+        return False
+
+    def expire(self, now=None):
+        """End the windows that are over, and the oldest if there are too many.
+
+        Cheap enough to run for every record, since only ended windows at
+        the front are looked at.
+        """
+        if now is None:
+            now = time.time()
+        ended = []
+        with self.lock:
+            while self.seen:
+                entry = next(iter(self.seen.values()))
+                if now - entry[0] < self.window \
+                        and len(self.seen) < self.max_keys:
+                    break
+                ended.append(self.seen.popitem(last=False)[1])
+        # written outside the lock, since summaries pass through this filter
+        self.write_summaries(ended)
+
+    def key(self, record):
+        exc_type, _, tb = record.exc_info
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        if tb is None:
+            return record.name, exc_type, None, None
+        return (record.name, exc_type,
+                tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+    def flush(self):
+        """End every window, writing summaries for dropped repeats."""
+        with self.lock:
+            ended = list(self.seen.values())
+            self.seen.clear()
+        self.write_summaries(ended)
+
+    def write_summaries(self, ended):
+        for _, suppressed, name, levelno, message in ended:
+            if suppressed:
+                self.handler.handle(logging.makeLogRecord({
+                    "name": name, "levelno": levelno,
+                    "levelname": logging.getLevelName(levelno),
+                    "msg": "%d more like: %s",
+                    "args": (suppressed, message),
+                    "suppressed": suppressed}))
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the listener thread without formatting them.
+
+    The standard QueueHandler formats the traceback on the calling thread;
+    this one leaves that to the listener.  If the queue is full the record
+    is dropped rather than blocking the event loop, and the next record
+    that fits says how many were dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # emit holds the handler lock, so dropped needs no lock of its own
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped = 0
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """Write queued records, and dedup summaries when stopping."""
+
+    def __init__(self, log_queue, dedup, *handlers):
+        super().__init__(log_queue, *handlers)
+        self.dedup = dedup
+
+    def stop(self):
+        self.dedup.flush()
+        super().stop()
+
+
+def setup(name, filename, level):
+    """Send a logger's records to filename through a background thread.
+
+    Returns the listener, which should be stopped before exiting so that
+    queued records and dedup summaries are written.
+    """
+    log_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    handler = QueueHandler(log_queue)
+    dedup = DedupFilter(config.LOG_DEDUP_WINDOW, handler)
+    handler.addFilter(dedup)
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=config.LOG_MAX_BYTES,
+        backupCount=config.LOG_BACKUPS, encoding="utf-8")
+    file_handler.setFormatter(JSONFormatter())
+    listener = QueueListener(log_queue, dedup, file_handler)
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    listener.start()
+    return listener
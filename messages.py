@@ -1,11 +1,14 @@
-"""messages.py contains the bot's introduction and the error message."""
+"""messages.py contains the bot's introduction and the error messages."""
 
 import config
 
 
 def introduction(guild_id):
     """Returns a string introducing the bot."""
-    intro = INTRO.format(config.name) + "\n\n" + USAGE
+    intro = INTRO.format(config.name) + "\n\n"
+    if config.scan_messages and guild_id not in config.servers_no_scanning:
+        intro += USAGE + "\n"
+    intro += SLASH
     if guild_id not in config.servers_no_reacts:
         intro += "\n" + REACTS
     intro += "\n" + PREVENT
@@ -20,10 +23,18 @@ INTRO = """Hello, I'm Fanfiction Abstractor! I provide information about fanfict
 Please note the bot does not provide information about AO3 archive-locked works."""
 
 USAGE = "To use the bot, send a message containing a link to an AO3 or FFN work or series."
+SLASH = "To look up a single link, use /abstract with the link, and optionally the number of a work in a series."
 REACTS = "To get information about a fic in the series, react with the fic's number."
 PREVENT = "To prevent the bot from posting, put ! immediately before a link."
 DELETE = "To delete a bot message, reply to it with the message \"delete\"."
 HELP = "To trigger this message, tag me and say \"help\" or \"info\"."
 
+STALE_NOTE = ":warning: The site is not responding, so this information may be out of date."
+
+NO_LINK = "That doesn't look like a link to an AO3 or FFN work, or an AO3 series."
+NOT_SERIES = "A work number can only be used with an AO3 series link."
+NO_WORK = "Sorry, I couldn't find work {} in <{}>."
+NO_SUMMARY = "Sorry, I couldn't get information about <{}>."
+
 ERROR_MESSAGE = """Error on {}.
 If you can access the page in your browser, please @ {}."""
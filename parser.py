@@ -2,11 +2,16 @@
 
 from bs4 import BeautifulSoup
 import AO3
+from collections import OrderedDict
 # import cloudscraper
 import config
+import functools
 import json
+import messages
 import re
 import requests
+import threading
+import upstream
 
 HEADERS = {"User-Agent": "fanfiction-abstractor-bot"}
 FFN_GENRES = set()
@@ -28,33 +33,135 @@ for g1 in genres_list:
 REACTS = {"1️⃣": 1, "2️⃣": 2, "3️⃣": 3, "4️⃣": 4, "5️⃣": 5,
           "6️⃣": 6, "7️⃣": 7, "8️⃣": 8, "9️⃣": 9, "🔟": 10}
 
+# logged in AO3 session for archive-locked works, shared between lookups
+AO3_SESSION = None
+_ao3_session_lock = threading.Lock()
 
+# last summary generated for each work, served while its host is unreachable
+LAST_KNOWN = OrderedDict()
+# work link for each chapter link seen, so chapters share their work's entry
+CHAPTER_WORKS = OrderedDict()
+_last_known_lock = threading.Lock()
+
+
+def strip_collection(link):
+    """Returns an AO3 link without a /collections/name/ prefix."""
+    if "/collections/" not in link:
+        return link
+    link = link.split("/")
+    link.pop(3)
+    link.pop(3)
+    return "/".join(link)
+
+
+def canonical_link(link):
+    """Returns the link that identifies the same work or series as link."""
+    link = strip_collection(link)
+    with _last_known_lock:
+        return CHAPTER_WORKS.get(link, link)
+
+
+def _remember(cache, key, value):
+    """Store key in one of the bounded caches; hold _last_known_lock."""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > config.STALE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def remember_chapter(link, work_link):
+    """Record that a chapter link belongs to work_link."""
+    with _last_known_lock:
+        _remember(CHAPTER_WORKS, strip_collection(link), work_link)
+
+
+def serve_stale(generate):
+    """Fall back to the last known summary while the host's breaker is open.
+
+    generate should be one of the generate_*_summary functions.
+    Successful summaries are remembered by canonical_link, so the same work
+    linked through a collection or a chapter shares one entry,
+    up to config.STALE_CACHE_SIZE links.
+    """
+    @functools.wraps(generate)
+    def wrapper(link):
+        try:
+            output = generate(link)
+        except upstream.CircuitOpenError:
+            key = canonical_link(link)
+            with _last_known_lock:
+                stale = LAST_KNOWN.get(key)
+            if stale is None:
+                return ""
+            return messages.STALE_NOTE + "\n" + stale
+        if output:
+            # chapters are mapped to their work while generating, so
+            # the key is only worked out afterwards
+            key = canonical_link(link)
+            # summaries are generated on worker threads, so share carefully
+            with _last_known_lock:
+                _remember(LAST_KNOWN, key, output)
+        return output
+    return wrapper
+
+
+def fetch_locked_ao3_page(link):
+    """Fetch an archive-locked AO3 page as the user in config.py.
+
+    The page is fetched through upstream.get, so it gets AO3's timeout and
+    breaker.  The login itself is sent by the AO3 library, which cannot be
+    given a timeout, so the session is reused between lookups.  Logging in
+    happens outside the lock, so a hung login only holds up its own lookup.
+    If AO3 has expired the session, it logs in again once.
+    Returns the parsed page.
+    """
+    global AO3_SESSION
+    for _ in range(2):
+        with _ao3_session_lock:
+            ao3_session = AO3_SESSION
+        if ao3_session is None:
+            ao3_session = AO3.Session(
+                config.AO3_USERNAME, config.AO3_PASSWORD)
+            with _ao3_session_lock:
+                AO3_SESSION = ao3_session
+        r = upstream.get(link, HEADERS, session=ao3_session.session)
+        if not r.url.startswith("https://archiveofourown.org/users/login"):
+            break
+        # sent back to the login page, so the session has expired
+        with _ao3_session_lock:
+            if AO3_SESSION is ao3_session:
+                AO3_SESSION = None
+    return BeautifulSoup(r.text, "lxml")
+
+
+@serve_stale
 def generate_ao3_work_summary(link):
     """Generate the summary of an AO3 work.
 
     link should be a link to an AO3 fic
     Returns the message with the fic info, or else a blank string
     """
-    r = requests.get(link, headers=HEADERS)
+    r = upstream.get(link, HEADERS)
     if r.status_code != requests.codes.ok:
         return ""
     soup = BeautifulSoup(r.text, "lxml")
     if r.url == "https://archiveofourown.org/users/login?restricted=true":
-        ao3_session = AO3.Session(config.AO3_USERNAME, config.AO3_PASSWORD)
-        soup = ao3_session.request(link)
+        soup = fetch_locked_ao3_page(link)
         locked_fic = True
     else:
         locked_fic = False
 
     preface = soup.find(class_="preface group")
     if preface is None:
-        r = requests.get(link+"?view_adult=true", headers=HEADERS)
+        r = upstream.get(link + "?view_adult=true", HEADERS)
         soup = BeautifulSoup(r.text, "lxml")
 
     # if chapter link, replace with work link
     if "/chapters/" in link:
         share = soup.find(class_="share")
         work_id = share.a["href"].strip("/works/").strip("/share")
+        remember_chapter(
+            link, "https://archiveofourown.org/works/{}".format(work_id))
         link = "https://archiveofourown.org/works/{}".format(work_id)
 
     preface = soup.find(class_="preface group")
@@ -181,19 +288,19 @@ def generate_ao3_work_summary(link):
     return output
 
 
+@serve_stale
 def generate_ao3_series_summary(link):
     """Generate the summary of an AO3 work.
 
     link should be a link to an AO3 series
     Returns the message with the series info, or else a blank string
     """
-    r = requests.get(link, headers=HEADERS)
+    r = upstream.get(link, HEADERS)
     if r.status_code != requests.codes.ok:
         return ""
     soup = BeautifulSoup(r.text, "lxml")
     if r.url == "https://archiveofourown.org/users/login?restricted=true":
-        ao3_session = AO3.Session(config.AO3_USERNAME, config.AO3_PASSWORD)
-        soup = ao3_session.request(link)
+        soup = fetch_locked_ao3_page(link)
         locked_fic = True
     else:
         locked_fic = False
@@ -262,7 +369,7 @@ def identify_work_in_ao3_series(link, number):
     link should be a link to a series, number is an int for which fic
     Returns the link to that number fic in the series, or else None
     """
-    r = requests.get(link, headers=HEADERS)
+    r = upstream.get(link, HEADERS)
     if r.status_code != requests.codes.ok:
         return None
     if r.url == "https://archiveofourown.org/users/login?restricted=true":
@@ -282,6 +389,7 @@ def identify_work_in_ao3_series(link, number):
     return fic.h4.a["href"]
 
 
+@serve_stale
 def generate_ffn_work_summary(link):
     """Generate summary of FFN work.
 
@@ -291,7 +399,7 @@ def generate_ffn_work_summary(link):
 
     fichub_link = "https://fichub.net/api/v0/epub?q=" + link
     MY_HEADER = {"User-Agent": config.name}
-    r = requests.get(fichub_link, headers=MY_HEADER)
+    r = upstream.get(fichub_link, MY_HEADER)
     if r.status_code != requests.codes.ok:
         return None
     metadata = json.loads(r.text)["meta"]
@@ -351,6 +459,7 @@ def generate_ffn_work_summary(link):
     return output
 
 
+@serve_stale
 def generate_sb_summary(link):
     """Generate summary of SpaceBattles work.
 
@@ -360,7 +469,7 @@ def generate_sb_summary(link):
 
     fichub_link = "https://fichub.net/api/v0/epub?q=" + link
     MY_HEADER = {"User-Agent": config.name}
-    r = requests.get(fichub_link, headers=MY_HEADER)
+    r = upstream.get(fichub_link, MY_HEADER)
     if r.status_code != requests.codes.ok:
         return None
     metadata = json.loads(r.text)["meta"]
@@ -0,0 +1,318 @@
+"""upstream.py sends requests to AO3 and fichub on behalf of the parser.
+
+Every request gets a per-host timeout from config.py, and every host gets
+a circuit breaker.  After enough consecutive failures the breaker opens and
+requests to that host fail immediately with CircuitOpenError, instead of
+holding a typing indicator while the socket hangs.  Once the recovery time
+has passed a single probe request is let through; if it succeeds the
+breaker closes again, otherwise it stays open for another recovery period.
+
+Failed requests are retried with exponential backoff and full jitter, and a
+request slower than a percentile of the host's recent latencies is hedged:
+a second copy is sent, the first good response wins and the other is
+discarded.  Retries and hedges both spend from a per-host retry budget that
+each new request only partly refills, so they cannot multiply the load on a
+host that is already failing.
+"""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import config
+import random
+import requests
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+# number of recent latencies kept per host for choosing the hedge delay
+LATENCY_WINDOW = 100
+
+# host -> base URL to send that host's requests to instead, for loadtest.py
+OVERRIDES = {}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while a host's breaker is open."""
+
+    def __init__(self, host):
+        super().__init__("circuit breaker open for {}".format(host))
+        self.host = host
+
+
+class CircuitBreaker:
+    """Track failures for one host and decide whether to contact it."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold, recovery_time):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a request may be sent to the host now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened_at >= self.recovery_time:
+                # let exactly one probe through; others keep failing fast
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN \
+                    or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Limit retries and hedges to a fraction of a host's requests."""
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """Add credit for one new request."""
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Returns True and spends a token if a retry is allowed."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LatencyTracker:
+    """Remember recent response times for one host."""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        """Returns the pth percentile latency, or None without enough data."""
+        with self.lock:
+            if len(self.samples) < config.HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+BREAKERS = {}
+BUDGETS = {}
+LATENCIES = {}
+_hosts_lock = threading.Lock()
+# Requests are only sent from the parser's config.FETCH_WORKERS threads, and
+# each may hold one extra request (a hedge, or the loser of a hedged pair)
+# while it has a hedge slot, so the pool never makes a request wait.
+_executor = ThreadPoolExecutor(max_workers=2 * config.FETCH_WORKERS)
+_hedge_slots = threading.BoundedSemaphore(config.FETCH_WORKERS)
+
+
+def _for_host(table, host, factory):
+    """Returns table[host], creating it with factory() if needed."""
+    with _hosts_lock:
+        value = table.get(host)
+        if value is None:
+            value = factory()
+            table[host] = value
+        return value
+
+
+def breaker_for(host):
+    """Returns the circuit breaker for host, creating it if needed."""
+    return _for_host(BREAKERS, host, lambda: CircuitBreaker(
+        config.BREAKER_FAILURES, config.BREAKER_RECOVERY))
+
+
+def budget_for(host):
+    """Returns the retry budget for host, creating it if needed."""
+    return _for_host(BUDGETS, host, lambda: RetryBudget(
+        config.RETRY_BUDGET_RATIO, config.RETRY_BUDGET_MAX))
+
+
+def latencies_for(host):
+    """Returns the latency tracker for host, creating it if needed."""
+    return _for_host(LATENCIES, host, lambda: LatencyTracker(LATENCY_WINDOW))
+
+
+def backoff(attempt):
+    """Returns the delay before retry number attempt, with full jitter."""
+    ceiling = min(config.RETRY_MAX_DELAY,
+                  config.RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def _failed(r):
+    """Returns True if the response should count against the host."""
+    return r.status_code >= 500 or r.status_code == 429
+
+
+def _override(link):
+    """Returns link pointed at its host's stand-in server, if it has one."""
+    parts = urlsplit(link)
+    base = OVERRIDES.get(parts.hostname)
+    if base is None:
+        return link
+    base = urlsplit(base)
+    return urlunsplit(
+        (base.scheme, base.netloc, parts.path, parts.query, parts.fragment))
+
+
+def get(link, headers, session=None):
+    """Send a GET request to link, honouring the host's timeout and breaker.
+
+    session may be a requests.Session to send the request with, e.g. one
+    logged in to AO3; otherwise the request is sent without one.
+
+    Failures are retried up to config.RETRY_ATTEMPTS times while the
+    host's retry budget allows it, so only use this for idempotent requests.
+    Raises CircuitOpenError if the host is not being contacted right now,
+    and lets requests exceptions (including timeouts) propagate.
+    Server errors and rate limiting count as failures but are returned.
+    """
+    host = urlsplit(link).hostname
+    breaker = breaker_for(host)
+    budget = budget_for(host)
+    budget.deposit()
+    link = _override(link)
+    if not breaker.allow():
+        raise CircuitOpenError(host)
+    # the breaker sees one outcome per call, however many attempts it took
+    attempt = 0
+    while True:
+        try:
+            r = _send(link, headers, host, budget, session)
+        # a read timeout has already waited the longest the host is allowed,
+        # so retrying it would hold the reply for minutes
+        except requests.ReadTimeout:
+            breaker.record_failure()
+            raise
+        except requests.RequestException:
+            if not _may_retry(attempt, breaker, budget):
+                breaker.record_failure()
+                raise
+        else:
+            if not _failed(r):
+                breaker.record_success()
+                return r
+            if not _may_retry(attempt, breaker, budget):
+                breaker.record_failure()
+                return r
+            r.close()
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+
+def _may_retry(attempt, breaker, budget):
+    """Returns True, spending from the budget, if a failure may be retried.
+
+    Retries stop once the breaker has been opened by other requests.
+    """
+    return attempt < config.RETRY_ATTEMPTS \
+        and breaker.state != CircuitBreaker.OPEN and budget.withdraw()
+
+
+def _timed_get(link, headers, timeout, latencies, session, started=None):
+    """Send one request and record how long the host took to answer.
+
+    started, if given, is an Event set when the request is actually sent.
+    """
+    if started:
+        started.set()
+    start = time.monotonic()
+    r = (session or requests).get(link, headers=headers, timeout=timeout)
+    latencies.record(time.monotonic() - start)
+    return r
+
+
+def _good(future):
+    """Returns True if a finished request produced a usable response."""
+    return future.exception() is None and not _failed(future.result())
+
+
+def _discard(future):
+    """Cancel a losing request, or close its response once it arrives."""
+    if future.cancel():
+        return
+    future.add_done_callback(
+        lambda f: f.exception() is None and f.result().close())
+
+
+def _send(link, headers, host, budget, session):
+    """Send a request, hedging it if it is slower than usual for the host."""
+    timeout = config.UPSTREAM_TIMEOUTS.get(host, config.DEFAULT_TIMEOUT)
+    latencies = latencies_for(host)
+    delay = None
+    if config.HEDGE_PERCENTILE:
+        delay = latencies.percentile(config.HEDGE_PERCENTILE)
+    if delay is None:
+        return _timed_get(link, headers, timeout, latencies, session)
+
+    started = threading.Event()
+    primary = _executor.submit(
+        _timed_get, link, headers, timeout, latencies, session, started)
+    # time the hedge delay from when the request is sent, not queued
+    started.wait()
+    done, _ = wait([primary], timeout=delay)
+    if done or not _hedge_slots.acquire(blocking=False):
+        return primary.result()
+    if not budget.withdraw():
+        _hedge_slots.release()
+        return primary.result()
+    hedge = _executor.submit(
+        _timed_get, link, headers, timeout, latencies, session)
+    _release_when_done([primary, hedge])
+    done, pending = wait([primary, hedge], return_when=FIRST_COMPLETED)
+    finished = list(done)
+    # if the first answer is an error, the other request may still succeed
+    if pending and not any(map(_good, finished)):
+        wait(pending)
+        finished += pending
+        pending = set()
+    winner = next(filter(_good, finished), finished[0])
+    for loser in finished + list(pending):
+        if loser is not winner:
+            _discard(loser)
+    return winner.result()
+
+
+def _release_when_done(futures):
+    """Free the hedge slot once every request of a hedged pair is done."""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            _hedge_slots.release()
+
+    for future in futures:
+        future.add_done_callback(finished)